@@ -1,70 +1,155 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from __future__ import print_function
-
-from typing import Union, List, Any, Sequence, Optional, Tuple, Dict
+from typing import (
+    Union,
+    List,
+    Any,
+    Sequence,
+    Optional,
+    Tuple,
+    Dict,
+    Iterator,
+)
 import ast
+import functools
 import subprocess
 import sys
 import os
+import shlex
+import threading
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor
 
-from six.moves import zip_longest
-from six import string_types
 import click
-import colorful as c
 
 
 NodeType = Union[ast.AST, List, str]
+Source = Union[bytes, str]
+
+
+# Placeholder for the fields that are not set in a node.
+_MISSING = object()
+
+
+class _End:
+    """Placeholder for the item after the end of the shorter of two lists. """
+
+    def __str__(self) -> str:
+        return "nothing"
+
+
+_END = _End()
+
+
+def _node_classes(cls: type = ast.AST) -> List[type]:
+    """Get `cls` and all its subclasses. """
+    classes = [cls]
+    for subclass in cls.__subclasses__():
+        classes.extend(_node_classes(subclass))
+    return classes
 
 
-# noinspection PyUnresolvedReferences
-color = c.format
+# Node classes with a line number, to avoid looking for it in other nodes.
+_HAS_LINENO = frozenset(
+    cls for cls in _node_classes() if "lineno" in cls._attributes
+)
 
 
-def compare_ast(left, right, line_counter=None):
-    # type: (NodeType, NodeType, Optional[Dict[str, int]]) -> None
+def compare_ast(
+    left: NodeType,
+    right: NodeType,
+    line_counter: Optional[Dict[str, int]] = None,
+) -> None:
     """Compare two abstract syntax trees.
 
     Return `None` if they are equal, and raise an exception otherwise.
+
+    The trees are traversed in pre-order with an explicit stack instead of
+    recursion, so deeply nested trees don't hit the recursion limit. Subtrees
+    that are the same object on both sides are not traversed; `ast.parse`
+    shares the nodes of contexts and operators, like `Load` or `Add`.
     """
     if line_counter is None:
         line_counter = {}
 
-    assert_equal(type(left), type(right), line_counter)
-
-    if isinstance(left, ast.AST):
-        line_counter["left"] = getattr(
-            left, "lineno", line_counter.get("left", 1)
-        )
-        line_counter["right"] = getattr(
-            right, "lineno", line_counter.get("right", 1)
-        )
+    # The pairs of nodes to visit are kept in two parallel stacks, to avoid
+    # allocating a tuple for each of them.
+    left_stack: List[Any] = [left]
+    right_stack: List[Any] = [right]
+    while left_stack:
+        left = left_stack.pop()
+        right = right_stack.pop()
+        if left is right:
+            continue
+        # `assert_equal` is inlined in this loop, since it's the hot path.
+        if type(left) is not type(right):
+            if left is _END or right is _END:
+                # Report the line of the extra item.
+                if left is _END:
+                    side, node = "right", right
+                else:
+                    side, node = "left", left
+                line_counter[side] = getattr(
+                    node, "lineno", line_counter.get(side, 1)
+                )
+                raise AssertionError(_format_diff(left, right, line_counter))
+            raise AssertionError(
+                _format_diff(type(left), type(right), line_counter)
+            )
 
-        left_fields = ast.iter_fields(left)
-        right_fields = ast.iter_fields(right)
-        for left_field, right_field in zip_longest(
-            left_fields, right_fields, fillvalue=""
-        ):
-            left_name, left_values = left_field
-            right_name, right_values = right_field
-            assert_equal(left_name, right_name, line_counter)
-            compare_ast(left_values, right_values, line_counter)
-    elif isinstance(left, list):
-        for left_child, right_child in zip_longest(left, right, fillvalue=""):
-            compare_ast(left_child, right_child, line_counter)
-    else:
-        assert_equal(left, right, line_counter)
+        if isinstance(left, ast.AST):
+            if type(left) in _HAS_LINENO:
+                line_counter["left"] = getattr(
+                    left, "lineno", line_counter.get("left", 1)
+                )
+                line_counter["right"] = getattr(
+                    right, "lineno", line_counter.get("right", 1)
+                )
+            else:
+                line_counter.setdefault("left", 1)
+                line_counter.setdefault("right", 1)
+
+            # Push the children in reverse to visit them in order.
+            for name in reversed(left._fields):
+                left_stack.append(getattr(left, name, _MISSING))
+                right_stack.append(getattr(right, name, _MISSING))
+        elif isinstance(left, list):
+            if len(left) != len(right):
+                # Compare the common items first, and then the first extra
+                # item against the end of the other list.
+                size = min(len(left), len(right))
+                left_stack.append(left[size] if size < len(left) else _END)
+                right_stack.append(right[size] if size < len(right) else _END)
+                left, right = left[:size], right[:size]
+            left_stack.extend(reversed(left))
+            right_stack.extend(reversed(right))
+        elif left != right:
+            raise AssertionError(_format_diff(left, right, line_counter))
+
+
+def compare_source(old: Source, new: Source) -> None:
+    """Parse two versions of a file and compare their ASTs.
+
+    Raise `SyntaxError` if any of them can't be parsed, and `AssertionError`
+    if they are different.
+    """
+    compare_ast(ast.parse(old), ast.parse(new))
 
 
-def assert_equal(left, right, line_counter):
-    # type: (Any, Any, Dict[str, int]) -> None
+def assert_equal(left: Any, right: Any, line_counter: Dict[str, int]) -> None:
     """Compare two objects.
 
     Return `None` if equal, and raise an exception with the line number
     otherwise.
     """
-    assert left == right, (
+    if left != right:
+        raise AssertionError(_format_diff(left, right, line_counter))
+
+
+def _format_diff(left: Any, right: Any, line_counter: Dict[str, int]) -> str:
+    """Describe two different objects and where they are. """
+    return (
         "different nodes:\n"
         "line {} in first commit: {}\n"
         "line {} in second commit: {}".format(
@@ -76,8 +161,7 @@ def assert_equal(left, right, line_counter):
     )
 
 
-def nice(obj):
-    # type: (Any) -> str
+def nice(obj: Any) -> str:
     """Get a nice repr of AST objects, or the usual `str` otherwise. """
 
     if isinstance(obj, ast.AST):
@@ -87,62 +171,316 @@ def nice(obj):
     return str(obj)
 
 
-def shell(cmd):
-    # type: (str) -> string_types
+def shell(cmd: str) -> str:
+    """Run a command and get its output as a stripped string.
+
+    Use it for short outputs, like hashes. The contents of files are read with
+    `GitCatFile` and `get_object` as bytes, without decoding them.
+    """
     return (
-        subprocess.check_output(cmd.split(), stderr=subprocess.STDOUT)
+        subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT)
         .decode("utf-8")
         .strip()
     )
 
 
-def get_object(commit, path):
-    # type: (Optional[str], str) -> string_types
-    """Get a file from git at a given commit.
+class GitCatFile:
+    """A long-running `git cat-file --batch` process.
+
+    Use it as a context manager, and call `read` to get the contents of files
+    at given commits. All the reads share the same `git` process, so the cost
+    of starting `git` is paid once per run instead of once per file.
+
+    Call `request` for the objects needed in advance: a background thread
+    collects their contents as they arrive, while the caller is busy with the
+    previous ones.
+    """
+
+    def __init__(self) -> None:
+        self.process: Optional[subprocess.Popen] = None
+        self.results: Dict[Tuple[str, str], Any] = {}
+        self.events: Dict[Tuple[str, str], threading.Event] = {}
+        # The objects requested, in order, and `None` when there are no more.
+        self.requests: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self.reader: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "GitCatFile":
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.reader = threading.Thread(target=self._read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        try:
+            self.process.stdin.close()
+        except OSError:
+            # `git` died, and the reader thread already reported it.
+            pass
+        self.requests.put(None)
+        self.reader.join()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def request(self, commit: str, path: str) -> None:
+        """Ask for the contents of `path` at `commit`, without waiting.
+
+        Requesting the same object more than once has no effect.
+        """
+        key = (commit, path)
+        if key in self.events:
+            return
+
+        self.events[key] = threading.Event()
+        self.requests.put(key)
+        try:
+            self.process.stdin.write("{}:{}\n".format(*key).encode("utf-8"))
+        except OSError:
+            # `git` died, and the reader thread will report it.
+            pass
+
+    def flush(self) -> None:
+        """Send the pending requests to `git`. """
+        try:
+            self.process.stdin.flush()
+        except OSError:
+            # `git` died, and the reader thread will report it.
+            pass
+
+    def ready(self, commit: str, path: str) -> bool:
+        """Tell if `read` can return the requested `path` at `commit` now. """
+        event = self.events.get((commit, path))
+        return event is not None and event.is_set()
+
+    def read(self, commit: str, path: str) -> bytes:
+        """Get the contents of `path` at `commit`.
+
+        The contents are handed over to the caller and not kept, so reading
+        the same object again requests it again.
+
+        Raise `subprocess.CalledProcessError` if the object does not exist.
+        """
+        key = (commit, path)
+        self.request(commit, path)
+        self.flush()
+        self.events[key].wait()
+        del self.events[key]
+        result = self.results.pop(key)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _read_response(self, key: Tuple[str, str]) -> bytes:
+        """Read the contents of one object from `git`.
+
+        Raise `subprocess.CalledProcessError` if the object does not exist or
+        is not a file, and `EOFError` if `git` stopped answering or its output
+        can't be followed.
+        """
+        # The header is "<sha> <type> <size>", or "<obj> missing" where the
+        # object name may contain spaces.
+        header = self.process.stdout.readline()
+        if not header:
+            raise EOFError()
+        if header.endswith((b" missing\n", b" ambiguous\n")):
+            raise self._error(key, header)
+        fields = header.rstrip(b"\n").rsplit(b" ", 2)
+        if len(fields) != 3 or not fields[2].isdigit():
+            raise EOFError()
+        kind, size = fields[1], int(fields[2])
+        content = self.process.stdout.read(size)
+        # The contents are followed by a newline; read it separately to avoid
+        # copying the contents to strip it.
+        if len(content) != size or self.process.stdout.read(1) != b"\n":
+            raise EOFError()
+        if kind != b"blob":
+            raise self._error(key, header)
+        return content
+
+    def _read_responses(self) -> None:
+        broken = False
+        for key in iter(self.requests.get, None):
+            try:
+                if broken:
+                    self.results[key] = self._error(key, b"")
+                else:
+                    self.results[key] = self._read_response(key)
+            except subprocess.CalledProcessError as exc:
+                self.results[key] = exc
+            except EOFError:
+                broken = True
+                self.results[key] = self._error(key, b"")
+            except Exception as exc:
+                # The position in the output is unknown after this.
+                broken = True
+                self.results[key] = exc
+            finally:
+                # Never leave `read` waiting.
+                if key not in self.results:
+                    self.results[key] = self._error(key, b"")
+                self.events[key].set()
+
+    @staticmethod
+    def _error(
+        key: Tuple[str, str], output: bytes
+    ) -> subprocess.CalledProcessError:
+        obj = "{}:{}".format(*key)
+        return subprocess.CalledProcessError(
+            128, ["git", "cat-file", "blob", obj], output=output
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_top_level() -> str:
+    """Get the root directory of the working tree. """
+    return shell("git rev-parse --show-toplevel")
+
+
+def get_object(
+    cat_file: GitCatFile, commit: Optional[str], path: str
+) -> bytes:
+    """Get the raw contents of a file from git at a given commit.
 
     If `commit` is None, get the file from the working tree.
     """
     if commit is None:
-        top_level = shell("git rev-parse --show-toplevel")
-        file_path = os.path.join(top_level, path)
-        with open(file_path) as f:
+        file_path = os.path.join(get_top_level(), path)
+        with open(file_path, "rb") as f:
             return f.read()
-    return shell("git show {}:{}".format(commit, path))
+    return cat_file.read(commit, path)
+
+
+class ComparePool:
+    """Compare sources in a process pool, started for the second file.
+
+    Starting the workers costs more than comparing one file, so a diff with a
+    single file to parse, like a commit hook's, is compared in this process.
+    Call `run_pending` once all the files are submitted.
+    """
+
+    def __init__(self) -> None:
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # The first file submitted, while there is no pool.
+        self.pending: Optional[Tuple[Future, Source, Source]] = None
+
+    def __enter__(self) -> "ComparePool":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def submit(self, old: Source, new: Source) -> Future:
+        """Start comparing `old` and `new` with `compare_source`. """
+        if self.executor is None and self.pending is None:
+            self.pending = (Future(), old, new)
+            return self.pending[0]
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor()
+        future = self.executor.submit(compare_source, old, new)
+        # Compare the first file while the workers take the next ones.
+        self.run_pending()
+        return future
+
+    def run_pending(self) -> None:
+        """Compare the file kept for this process, if any. """
+        if self.pending is None:
+            return
+
+        future, old, new = self.pending
+        self.pending = None
+        try:
+            compare_source(old, new)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(None)
+
+
+def submit_file(
+    pool: ComparePool,
+    cat_file: GitCatFile,
+    commit1: str,
+    commit2: Optional[str],
+    path: str,
+) -> Future:
+    """Start comparing a file between two commits in `pool`.
+
+    Return a future with the result of `compare_source`.
+    """
+    future: Future = Future()
+    try:
+        old = get_object(cat_file, commit1, path)
+        new = get_object(cat_file, commit2, path)
+    except subprocess.CalledProcessError as exc:
+        future.set_exception(exc)
+        return future
+
+    if old == new:
+        # Identical files have the same AST, don't parse them.
+        future.set_result(None)
+        return future
+    return pool.submit(old, new)
 
 
-def collect_paths(from_commit, to_commit):
-    # type: (str, Optional[str]) -> List[string_types]
-    """Get the list of changed files between two commits.
+def collect_paths(from_commit: str, to_commit: Optional[str]) -> Iterator[str]:
+    """Get the changed files between two commits.
 
     If `to_commit` is None, diff against the current working tree.
+
+    The paths are yielded as `git` outputs them, so the caller can start
+    working before the diff is complete. Raise
+    `subprocess.CalledProcessError` at the end if `git` failed.
     """
     cmd = "git diff --name-only {}".format(from_commit)
 
     if to_commit:
         cmd += " {}".format(to_commit)
 
+    c = colors()
     # noinspection PyUnresolvedReferences
     stderr(c.lightSlateGray | "Running: {cmd}".format(cmd=cmd))
-    return shell(cmd).splitlines()
+    args = shlex.split(cmd)
+    with subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ) as process:
+        for line in process.stdout:
+            yield line.decode("utf-8").rstrip("\n")
+        output = process.stderr.read()
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, args, output=output
+        )
 
 
-def get_ref(commit):
-    # type: (Optional[str]) -> Optional[str]
-    """Convert a commit to its hash.
+def get_refs(commits: Sequence[Optional[str]]) -> List[Optional[str]]:
+    """Convert commits to their hashes, with a single call to `git`.
 
     It handles the syntax for references, such as special names like HEAD or
     @, parents commits, and many more. See `git help rev-parse` for full
     reference.
 
-    Return `None` if the input is `None`.
+    The hash of a `None` commit is `None`. Raise `ValueError` if `git` doesn't
+    output one hash per commit.
     """
-    if commit is None:
-        return None
-    return shell("git rev-parse {}".format(commit))
+    refs = [commit for commit in commits if commit is not None]
+    hashes = (
+        shell("git rev-parse {}".format(" ".join(refs))).splitlines()
+        if refs
+        else []
+    )
+    if len(hashes) != len(refs) or not all(refs):
+        raise ValueError("invalid commit references: {}".format(commits))
+    hashes.reverse()
+    return [None if commit is None else hashes.pop() for commit in commits]
 
 
-def get_commits(commits):
-    # type: (Sequence[str]) -> Tuple[str, Optional[str]]
+def get_commits(commits: Sequence[str]) -> Tuple[str, Optional[str]]:
     """Process the commit references given as parameters to the command.
 
     Return a pair of hashes identifying the range that we want to compare.
@@ -163,50 +501,80 @@ def get_commits(commits):
     elif len(commits) == 1:
         commit2 = commits[0]
         if "..." in commit2:
-            c1, c2 = map(get_ref, commit2.split("..."))
+            # Like `git`, an empty side of A...B means HEAD.
+            c1, c2 = get_refs(
+                [commit or "HEAD" for commit in commit2.split("...")]
+            )
             base = shell("git merge-base {} {}".format(c1, c2))
             return base, c2
-        commit1 = "{}~1".format(get_ref(commit2))
+        commit1 = "{}~1".format(commit2)
     elif len(commits) == 2:
         commit1, commit2 = commits
         if commit2 == ".":
             commit2 = None
     else:
         raise ValueError("invalid commit references: {}".format(commits))
-    return get_ref(commit1), get_ref(commit2)
+    commit1, commit2 = get_refs([commit1, commit2])
+    return commit1, commit2
+
 
+@functools.lru_cache(maxsize=None)
+def colors() -> Any:
+    """Get the `colorful` module.
 
-def stderr(*messages, **kwargs):
-    # type: (Any, Any) -> None
+    It's imported on first use, so that importing this module stays cheap for
+    the workers of the process pool, and for users of `compare_ast`.
+    """
+    import colorful
+
+    return colorful
+
+
+_stderr_buffer: List[str] = []
+
+
+def stderr(*messages: Any, buffer: bool = False, **kwargs: Any) -> None:
     """Send messages to stderr.
 
     Print one argument per line, and support colored arguments.
-    `kwargs` are passed to the `print` function.
+    With `buffer=True`, keep the messages until the next call to
+    `flush_stderr`, or to `stderr` without it. Other `kwargs` are passed to the
+    `print` function.
     """
-    print(
-        color("\n".join(str(msg) for msg in messages if str(msg))),
-        file=sys.stderr,
-        **kwargs
+    message = colors().format(
+        "\n".join(str(msg) for msg in messages if str(msg))
     )
+    if buffer:
+        _stderr_buffer.append(message + kwargs.get("end", "\n"))
+        return
+
+    flush_stderr()
+    print(message, file=sys.stderr, **kwargs)
+
+
+def flush_stderr() -> None:
+    """Write the messages buffered by `stderr` all at once. """
+    if not _stderr_buffer:
+        return
 
+    sys.stderr.write("".join(_stderr_buffer))
+    sys.stderr.flush()
+    del _stderr_buffer[:]
 
-def error(*messages):
-    # type: (str) -> None
+
+def error(*messages: str) -> None:
     stderr("💥 🔥 💥", *messages)
 
 
-def shell_error(message, exc):
-    # type: (str, subprocess.CalledProcessError) -> None
+def shell_error(message: str, exc: subprocess.CalledProcessError) -> None:
     """Display an error from a shell command. """
     # noinspection PyUnresolvedReferences
-    error(message, c.orange | "'{}' failed".format(" ".join(exc.cmd)))
+    error(message, colors().orange | "'{}' failed".format(" ".join(exc.cmd)))
 
 
-# noinspection PyUnresolvedReferences
 @click.command(context_settings={"help_option_names": ["-h", "--help"]})
 @click.argument("commits", nargs=-1)
-def astdiff(commits):
-    # type: (Sequence[str]) -> None
+def astdiff(commits: Sequence[str]) -> None:
     """Compare the AST of all changed files between commits.
 
     \b
@@ -217,6 +585,7 @@ def astdiff(commits):
 
     (COMMIT2 can be a dot '.' to compare between COMMIT1 and the working tree)
     """
+    c = colors()
 
     try:
         commit1, commit2 = get_commits(commits)
@@ -227,39 +596,72 @@ def astdiff(commits):
         shell_error("Failed to compute commits", exc)
         sys.exit(1)
 
-    try:
-        paths = collect_paths(commit1, commit2)
-    except subprocess.CalledProcessError as exc:
-        shell_error("Failed to collect files", exc)
-        sys.exit(1)
-
     ok = 0
     fails = 0
     errors = 0
-    for path in paths:
-        if not path.endswith(".py"):
-            continue
-
+    paths = []
+    # The pool is shut down before `git cat-file`, since the workers inherit
+    # its pipes and `git` doesn't exit until they are closed.
+    with GitCatFile() as cat_file, ComparePool() as pool:
+        commits = [
+            commit for commit in (commit1, commit2) if commit is not None
+        ]
+        futures = []
+        # Request the files while `git diff` is still looking for them, and
+        # start comparing the ones whose contents already arrived, in order.
         try:
-            stderr(
-                "{c.cyan}Checking {path}{c.reset} ... ".format(c=c, path=path),
-                end="",
-            )
-            old = get_object(commit1, path)
-            new = get_object(commit2, path)
-            compare_ast(ast.parse(old), ast.parse(new))
-            stderr(c.green | "ok")
-            ok += 1
-        except AssertionError as exc:
-            stderr(c.bold & c.red | "failed", exc)
-            fails += 1
-        except SyntaxError as exc:
-            stderr(c.bold & c.orange | "failed to parse", exc)
-            errors += 1
+            for path in collect_paths(commit1, commit2):
+                if not path.endswith(".py"):
+                    continue
+                paths.append(path)
+                for commit in commits:
+                    cat_file.request(commit, path)
+                cat_file.flush()
+                while len(futures) < len(paths) and all(
+                    cat_file.ready(commit, paths[len(futures)])
+                    for commit in commits
+                ):
+                    path = paths[len(futures)]
+                    future = submit_file(
+                        pool, cat_file, commit1, commit2, path
+                    )
+                    futures.append((path, future))
         except subprocess.CalledProcessError as exc:
-            stderr("git failed")
-            shell_error("", exc)
-            errors += 1
+            shell_error("Failed to collect files", exc)
+            sys.exit(1)
+
+        for path in paths[len(futures) :]:
+            future = submit_file(pool, cat_file, commit1, commit2, path)
+            futures.append((path, future))
+        pool.run_pending()
+
+        # Buffer the report of the files that are ready, and write it when
+        # waiting for the next one.
+        checking = "{c.cyan}Checking {{path}}{c.reset} ... ".format(c=c)
+        ok_label = c.green | "ok"
+        failed_label = c.bold & c.red | "failed"
+        parse_failed_label = c.bold & c.orange | "failed to parse"
+        try:
+            for path, future in futures:
+                try:
+                    stderr(checking.format(path=path), end="", buffer=True)
+                    if not future.done():
+                        flush_stderr()
+                    future.result()
+                    stderr(ok_label, buffer=True)
+                    ok += 1
+                except AssertionError as exc:
+                    stderr(failed_label, exc, buffer=True)
+                    fails += 1
+                except SyntaxError as exc:
+                    stderr(parse_failed_label, exc, buffer=True)
+                    errors += 1
+                except subprocess.CalledProcessError as exc:
+                    stderr("git failed", buffer=True)
+                    shell_error("", exc)
+                    errors += 1
+        finally:
+            flush_stderr()
 
     if fails == errors == 0:
         stderr(c.green | "✨ All files are equivalent! ✨")
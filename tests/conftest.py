@@ -1,4 +1,5 @@
 import ast
+import subprocess
 from textwrap import dedent
 
 import pytest
@@ -69,3 +70,23 @@ def ast_line1():
         """
     )
     return ast.parse(code)
+
+
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def git(*args):
+        return subprocess.check_output(("git",) + args).decode("utf-8").strip()
+
+    git("init", "-q")
+    git("config", "user.email", "astdiff@example.com")
+    git("config", "user.name", "astdiff")
+    (tmp_path / "foo.py").write_text("x = (1, 2, 'foo')\n")
+    git("add", "foo.py")
+    git("commit", "-q", "-m", "first")
+    (tmp_path / "foo.py").write_text('x = (\n    1,\n    2,\n    "foo",\n)\n')
+    (tmp_path / "bar.py").write_text("y = 1\n")
+    git("add", "foo.py", "bar.py")
+    git("commit", "-q", "-m", "second")
+    return git
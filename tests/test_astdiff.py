@@ -1,8 +1,25 @@
 import pytest
 import ast
+import os
+import re
+import subprocess
+
+from click.testing import CliRunner
 
 from astdiff import __version__
-from astdiff.astdiff import compare_ast, assert_equal
+from astdiff.astdiff import (
+    compare_ast,
+    compare_source,
+    assert_equal,
+    collect_paths,
+    get_commits,
+    get_refs,
+    stderr,
+    flush_stderr,
+    GitCatFile,
+    ComparePool,
+    astdiff,
+)
 
 
 def test_version():
@@ -33,6 +50,8 @@ def test_compare_equal_lists():
 def test_compare_different_length_lists():
     with pytest.raises(AssertionError):
         assert compare_ast(["foo"], ["spam", "eggs"])
+    with pytest.raises(AssertionError):
+        assert compare_ast(["foo"], ["foo", ""])
 
 
 def test_compare_equal_values():
@@ -74,3 +93,205 @@ def test_compare_line_numbers(ast_set1, ast_line1):
         compare_ast(ast_set1, ast_line1, d)
     assert d["left"] == 2
     assert d["right"] == 5
+
+
+def test_compare_source():
+    assert compare_source(b"x = (1, 2)", "x = (\n    1,\n    2,\n)") is None
+    with pytest.raises(AssertionError):
+        compare_source(b"x = 1", b"x = 2")
+    with pytest.raises(SyntaxError):
+        compare_source(b"x = 1", b"x = (")
+
+
+def test_git_cat_file_reads_objects(git_repo):
+    with GitCatFile() as cat_file:
+        assert cat_file.read("HEAD~1", "foo.py") == b"x = (1, 2, 'foo')\n"
+        assert cat_file.read("HEAD", "bar.py") == b"y = 1\n"
+        assert cat_file.read("HEAD", "foo.py").startswith(b"x = (\n")
+
+
+def test_git_cat_file_missing_object(git_repo):
+    with GitCatFile() as cat_file:
+        with pytest.raises(subprocess.CalledProcessError):
+            cat_file.read("HEAD~1", "bar.py")
+        # The process is still usable after a missing object.
+        assert cat_file.read("HEAD", "bar.py") == b"y = 1\n"
+
+
+def test_git_cat_file_missing_path_with_spaces(git_repo):
+    with GitCatFile() as cat_file:
+        with pytest.raises(subprocess.CalledProcessError):
+            cat_file.read("HEAD", "sp ace.py")
+        with pytest.raises(subprocess.CalledProcessError):
+            cat_file.read("HEAD", "one two missing.py")
+        assert cat_file.read("HEAD", "bar.py") == b"y = 1\n"
+
+
+def test_git_cat_file_not_a_file(git_repo):
+    with GitCatFile() as cat_file:
+        # The root of the commit is a tree, not a blob.
+        with pytest.raises(subprocess.CalledProcessError):
+            cat_file.read("HEAD", "")
+        assert cat_file.read("HEAD", "bar.py") == b"y = 1\n"
+
+
+def test_git_cat_file_request(git_repo):
+    with GitCatFile() as cat_file:
+        assert not cat_file.ready("HEAD", "bar.py")
+        cat_file.request("HEAD~1", "foo.py")
+        cat_file.request("HEAD~1", "bar.py")
+        cat_file.request("HEAD", "bar.py")
+        cat_file.request("HEAD~1", "foo.py")
+        cat_file.flush()
+        cat_file.read("HEAD", "bar.py")
+        assert cat_file.ready("HEAD~1", "foo.py")
+        # The contents are not kept after reading them, but can be read again.
+        assert not cat_file.ready("HEAD", "bar.py")
+        assert cat_file.read("HEAD", "bar.py") == b"y = 1\n"
+        with pytest.raises(subprocess.CalledProcessError):
+            cat_file.read("HEAD~1", "bar.py")
+        assert cat_file.read("HEAD~1", "foo.py") == b"x = (1, 2, 'foo')\n"
+
+
+def test_compare_deeply_nested():
+    code = "x = " + " + ".join(["1"] * 2000)
+    node = ast.parse(code)
+    assert compare_ast(node, ast.parse(code)) is None
+
+
+def test_compare_same_subtree():
+    nan = ast.Constant(value=float("nan"))
+    node1 = ast.Expression(body=nan)
+    node2 = ast.Expression(body=nan)
+    assert compare_ast(node1, node2) is None
+    with pytest.raises(AssertionError):
+        compare_ast(node1, ast.Expression(body=ast.Constant(value=float("nan"))))
+
+
+def test_get_refs(git_repo):
+    head = git_repo("rev-parse", "HEAD")
+    parent = git_repo("rev-parse", "HEAD~1")
+    assert get_refs(["HEAD", None, "HEAD~1"]) == [head, None, parent]
+    assert get_refs([None]) == [None]
+    with pytest.raises(ValueError):
+        get_refs(["HEAD", ""])
+
+
+def test_get_commits(git_repo):
+    head = git_repo("rev-parse", "HEAD")
+    parent = git_repo("rev-parse", "HEAD~1")
+    assert get_commits([]) == (head, None)
+    assert get_commits(["HEAD"]) == (parent, head)
+    assert get_commits(["HEAD~1", "."]) == (parent, None)
+    assert get_commits(["HEAD~1...HEAD"]) == (parent, head)
+    assert get_commits(["HEAD~1..."]) == (parent, head)
+    assert get_commits(["...HEAD"]) == (head, head)
+    with pytest.raises(ValueError):
+        get_commits(["HEAD...HEAD...HEAD"])
+
+
+def test_stderr_buffer(capsys):
+    stderr("foo", end="", buffer=True)
+    stderr("bar", buffer=True)
+    assert capsys.readouterr().err == ""
+    flush_stderr()
+    assert capsys.readouterr().err == "foobar\n"
+    stderr("spam", buffer=True)
+    stderr("eggs")
+    assert capsys.readouterr().err == "spam\neggs\n"
+
+
+def test_collect_paths(git_repo):
+    paths = collect_paths(git_repo("rev-parse", "HEAD~1"), None)
+    assert not isinstance(paths, list)
+    assert sorted(paths) == ["bar.py", "foo.py"]
+    with pytest.raises(subprocess.CalledProcessError):
+        list(collect_paths("not-a-commit", None))
+
+
+def test_compare_inserted_statement():
+    node1 = ast.parse("def f():\n    a = 1\n    return a\n")
+    node2 = ast.parse("def f():\n    a = 1\n    print(a)\n    return a\n")
+    d = {}
+    with pytest.raises(AssertionError) as exc:
+        compare_ast(node1, node2, d)
+    assert "Return" in str(exc.value)
+    assert "Expr" in str(exc.value)
+    assert d == {"left": 2, "right": 2}
+
+
+def test_compare_appended_statement():
+    node1 = ast.parse("a = 1\n")
+    node2 = ast.parse("a = 1\nprint(a)\n")
+    d = {}
+    with pytest.raises(AssertionError) as exc:
+        compare_ast(node1, node2, d)
+    assert "first commit: nothing" in str(exc.value)
+    assert "second commit: Expr" in str(exc.value)
+    assert d == {"left": 1, "right": 2}
+
+
+def test_cli_help():
+    result = CliRunner().invoke(astdiff, ["--help"])
+    assert result.exit_code == 0
+    assert result.output.startswith("Usage: astdiff [OPTIONS] [COMMITS]...")
+
+
+def test_cli_report(git_repo, tmp_path):
+    # Only a file with a mode change can be listed with identical contents;
+    # it's reported as ok without being parsed.
+    (tmp_path / "same.py").write_text("z = (\n")
+    (tmp_path / "broken.py").write_text("w = 0\n")
+    (tmp_path / "notes.txt").write_text("one\n")
+    git_repo("add", ".")
+    git_repo("commit", "-q", "-m", "third")
+    (tmp_path / "foo.py").write_text('x = (1, 2, "foo")\n')
+    (tmp_path / "bar.py").write_text("y = 2\n")
+    (tmp_path / "baz.py").write_text("v = 0\n")
+    (tmp_path / "broken.py").write_text("w = (\n")
+    (tmp_path / "notes.txt").write_text("two\n")
+    os.chmod(str(tmp_path / "same.py"), 0o755)
+    git_repo("add", ".")
+    git_repo("commit", "-q", "-m", "fourth")
+
+    result = CliRunner().invoke(astdiff, ["HEAD"])
+    output = re.sub(r"\x1b\[[0-9;]*m", "", result.output)
+    assert result.exit_code == 1
+    assert [
+        line for line in output.splitlines() if line.startswith("Checking")
+    ] == [
+        "Checking bar.py ... failed",
+        "Checking baz.py ... git failed",
+        "Checking broken.py ... failed to parse",
+        "Checking foo.py ... ok",
+        "Checking same.py ... ok",
+    ]
+    assert "notes.txt" not in output
+    assert "2 files ok" in output
+    assert "1 files failed" in output
+    assert "2 errors" in output
+
+    (tmp_path / "foo.py").write_text('x = (\n    1,\n    2,\n    "foo",\n)\n')
+    result = CliRunner().invoke(astdiff, [])
+    output = re.sub(r"\x1b\[[0-9;]*m", "", result.output)
+    assert result.exit_code == 0
+    assert "Checking foo.py ... ok" in output
+    assert "All files are equivalent!" in output
+
+
+def test_compare_pool():
+    with ComparePool() as pool:
+        first = pool.submit(b"x = 1", b"x = 2")
+        pool.run_pending()
+        assert pool.executor is None
+        with pytest.raises(AssertionError):
+            first.result()
+
+    with ComparePool() as pool:
+        first = pool.submit(b"x = 1", b"x = (")
+        second = pool.submit(b"x = 1", b"x = (1)")
+        assert pool.executor is not None
+        assert first.done()
+        with pytest.raises(SyntaxError):
+            first.result()
+        assert second.result() is None